@@ -4,6 +4,7 @@ import datetime
 from Crypto.PublicKey import RSA
 
 from server import Server, DataMode
+from runner import run
 from pathlib import Path
 import json
 import os
@@ -85,4 +86,4 @@ async def main():
         await abstract_server.serve_forever()
 
 
-asyncio.run(main())
+run(main())
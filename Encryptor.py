@@ -1,39 +1,72 @@
+import hmac
 import os
 
 from typing import Tuple
 
-from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Cipher import PKCS1_OAEP
 from Crypto.PublicKey.RSA import RsaKey
-from Crypto.Util.Padding import pad, unpad
 from Crypto import Random
 from Crypto.PublicKey import RSA
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, CipherContext, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+BLOCK_SIZE = algorithms.AES.block_size // 8
+
+NONCE_SIZE = 12
+
+TAG_SIZE = 16
+
+MAC_SIZE = 32
 
 
 class SymmetricEncryptor:
 
     def __init__(self, session_key):
         self.session_key = session_key
+        self.cipher_key = self.derive_key(session_key, b'encryption', len(session_key))
+        self.mac_key = self.derive_key(session_key, b'authentication', MAC_SIZE)
+
+        # built once per connection and shared by every message
+        self._aes = algorithms.AES(self.cipher_key)
+        self._aead = AESGCM(self.cipher_key)
+
+    @staticmethod
+    def derive_key(session_key: bytes, purpose: bytes, length: int):
+        return HKDF(algorithm=hashes.SHA256(), length=length, salt=None, info=purpose).derive(session_key)
 
     @staticmethod
     def generate_iv():
-        return Random.new().read(AES.block_size)
+        return Random.new().read(NONCE_SIZE)
+
+    @staticmethod
+    def derive_ivs(iv: bytes, count: int):
+        # every part of a message needs its own GCM nonce, they count up from the message iv
+        counter = int.from_bytes(iv, 'big')
+        return [((counter + i) % (1 << NONCE_SIZE * 8)).to_bytes(NONCE_SIZE, 'big') for i in range(count)]
+
+    def new_encryptor(self, iv) -> CipherContext:
+        return Cipher(self._aes, modes.GCM(iv)).encryptor()
+
+    def new_decryptor(self, iv) -> CipherContext:
+        return Cipher(self._aes, modes.GCM(iv)).decryptor()
 
     def encrypt(self, data: bytes, iv):
-        try:
-            cipher = AES.new(self.session_key, AES.MODE_CBC, iv)
-            ciphertext = cipher.encrypt(pad(data, AES.block_size))
-            return ciphertext
-        except ValueError:
-            print('please specify iv')
+        return self._aead.encrypt(iv, data, None)
 
     def decrypt(self, data: bytes, iv):
-        cipher = AES.new(self.session_key, AES.MODE_CBC, iv)
-        decrypted_data = unpad(cipher.decrypt(data), AES.block_size)
-        return decrypted_data
+        return self._aead.decrypt(iv, data, None)
+
+    def new_mac(self):
+        return hmac.new(self.mac_key, digestmod='sha256')
+
+    def mac(self, data: bytes):
+        return hmac.digest(self.mac_key, data, 'sha256')
 
     @staticmethod
     def generate_key():
-        return Random.get_random_bytes(AES.block_size)
+        return Random.get_random_bytes(BLOCK_SIZE)
 
 
 class AsymmetricEncryptor:
@@ -1,6 +1,7 @@
 import argparse
 import asyncio
 import functools
+import hmac
 import json
 import logging
 import sys
@@ -8,7 +9,7 @@ import tempfile
 import os
 from enum import Enum, auto
 from OpenSSL import crypto
-from concurrent.futures.thread import ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag
 from pathlib import Path
 
 from typing import Tuple, Optional
@@ -16,11 +17,12 @@ from typing.io import IO
 
 from Crypto.PublicKey import RSA
 
-from Encryptor import SymmetricEncryptor, AsymmetricEncryptor
+from Encryptor import SymmetricEncryptor, AsymmetricEncryptor, BLOCK_SIZE, NONCE_SIZE, TAG_SIZE, MAC_SIZE
 
-from hashlib import sha512
+CHUNK = 64 * 1024
 
-CHUNK = 1024
+# chunks coalesced by send_file into one write, the writer is drained after each
+WRITE_BATCH = 4
 
 BUFFER_LIMIT = 256 * 1024 * 1024
 
@@ -44,9 +46,16 @@ class Client:
 
         self.client_public_key, self.client_private_key = AsymmetricEncryptor.read_key_pairs(keys)
 
+        self._openssl_key = crypto.load_privatekey(crypto.FILETYPE_PEM, self.client_private_key.export_key())
+
+        self._client_pub_pem = self.client_public_key.export_key()
+
         self.encryptor = None
+        # frames of concurrent send and send_file calls must not interleave on the writer
+        self._send_lock = asyncio.Lock()
         self.csr = crypto.X509Req()
         self.cs = crypto.X509()
+        self.cs_pem: Optional[bytes] = None
         self.generate_csr()
 
         @self.event()
@@ -54,23 +63,44 @@ class Client:
             print('remote host disconnected')
                     
     async def write_to_file(self, file: IO, reader: asyncio.StreamReader, data_len: int, iv: bytes):
-        remaining = data_len
-        file_hash = sha512()
-        while remaining > 0:
-            chunk = min(remaining, CHUNK)
+        loop = asyncio.get_running_loop()
+        remaining = data_len - TAG_SIZE
+        file_hash = self.encryptor.new_mac()
+        decryptor = self.encryptor.new_decryptor(iv)
 
-            encrypted_data = await reader.read(chunk)
+        # update_into needs room for one extra block
+        plain_buffer = bytearray(CHUNK + BLOCK_SIZE - 1)
+        plain_view = memoryview(plain_buffer)
 
-            if len(encrypted_data) != chunk:
-                raise ConnectionError
+        def decrypt_chunk(encrypted_data: bytes):
+            data = plain_view[:decryptor.update_into(encrypted_data, plain_buffer)]
 
-            data = self.encryptor.decrypt(encrypted_data, iv)
+            file_hash.update(data)
 
             file.write(data)
 
-            file_hash.update(data)
+        # the previous chunk is decrypted in the pool while the next one is received
+        pending = None
+        try:
+            while remaining > 0:
+                chunk = min(remaining, CHUNK)
+
+                encrypted_data = await reader.readexactly(chunk)
+
+                if pending is not None:
+                    await pending
 
-            remaining -= chunk
+                pending = loop.run_in_executor(None, decrypt_chunk, encrypted_data)
+
+                remaining -= chunk
+
+            tag = await reader.readexactly(TAG_SIZE)
+        finally:
+            # never leave a chunk being written to the file when the peer goes away
+            if pending is not None:
+                await pending
+
+        decryptor.finalize_with_tag(tag)
 
         return file_hash.digest()
 
@@ -83,14 +113,9 @@ class Client:
         req.get_subject().stateOrProvinceName = 'Damascus'
         req.get_subject().localityName = 'Southern Syria'
 
-        # # Set the public key of the certificate to pkey.
-        opensslPublicKey = crypto.load_publickey(crypto.FILETYPE_PEM,
-                                                 open(f'client_keys/{self.name}_public.pem').read())
-        opensslPrivateKey = crypto.load_privatekey(crypto.FILETYPE_PEM,
-                                                   open(f'client_keys/{self.name}_private.pem').read())
-
-        req.set_pubkey(opensslPublicKey)
-        req.sign(opensslPrivateKey, "sha1")
+        # Set the public key of the certificate to the already loaded key pair.
+        req.set_pubkey(self._openssl_key)
+        req.sign(self._openssl_key, "sha256")
 
         self.csr = req
 
@@ -100,13 +125,14 @@ class Client:
         self.writer = writer
 
         # SENDING PUBLIC KEY TO  SERVER
-        public_key_len = len(self.client_public_key.export_key()).to_bytes(8, 'big')
+        public_key_len = len(self._client_pub_pem).to_bytes(8, 'big')
         writer.write(public_key_len)
-        writer.write(self.client_public_key.export_key())
+        writer.write(self._client_pub_pem)
 
         # RECEIVING SERVER PUBLIC KEY
-        key_len = int.from_bytes(await reader.read(8), 'big')
-        self.server_public_key = RSA.import_key(await reader.read(key_len))
+        key_len = int.from_bytes(await reader.readexactly(8), 'big')
+        server_public_key = await reader.readexactly(key_len)
+        self.server_public_key = RSA.import_key(server_public_key)
         # SEND ENCRYPTED SESSION KEY
         self.encryptor = SymmetricEncryptor(SymmetricEncryptor.generate_key())
 
@@ -122,7 +148,7 @@ class Client:
             connection_event.set()
         try:
             await self._process_incoming_events()
-        except ConnectionError:
+        except (ConnectionError, asyncio.IncompleteReadError, InvalidTag):
             asyncio.ensure_future(self.events['disconnect'][0](None))
         finally:
             self.writer.close()
@@ -139,26 +165,20 @@ class Client:
             pass
 
         while True:
-            iv = await self.reader.read(16)
-
-            if len(iv) != 16:
-                raise ConnectionError
+            # the nonce and the sealed header length arrive together
+            frame = await self.reader.readexactly(NONCE_SIZE + 8 + TAG_SIZE)
 
-            encrypted_data = await self.reader.read(16)
+            iv, encrypted_data = frame[:NONCE_SIZE], frame[NONCE_SIZE:]
 
-            if len(encrypted_data) != 16:
-                raise ConnectionError
+            len_iv, header_iv, data_iv = SymmetricEncryptor.derive_ivs(iv, 3)
 
-            data = self.encryptor.decrypt(encrypted_data, iv)
+            data = self.encryptor.decrypt(encrypted_data, len_iv)
 
             data_len = int.from_bytes(data, 'big')
 
-            encrypted_data = await self.reader.read(data_len)
+            encrypted_data = await self.reader.readexactly(data_len)
 
-            if len(encrypted_data) != data_len:
-                raise ConnectionError
-
-            data = self.encryptor.decrypt(encrypted_data, iv)
+            data = self.encryptor.decrypt(encrypted_data, header_iv)
 
             data = json.loads(data)
 
@@ -172,33 +192,21 @@ class Client:
             hsh = None
 
             if data_mode == DataMode.BYTES:
-                buffer = await self.reader.read(data_len)
-
-                if len(buffer) != data_len:
-                    raise ConnectionError
+                buffer = await self.reader.readexactly(data_len)
 
-                buffer = self.encryptor.decrypt(buffer, iv)
+                buffer = self.encryptor.decrypt(buffer, data_iv)
 
-                hsh = sha512(buffer).digest()
+                hsh = self.encryptor.mac(buffer)
 
             if data_mode == DataMode.FILE:
                 tmp_file = tempfile.TemporaryFile()
-                hsh = await self.write_to_file(tmp_file, self.reader, data_len, iv)
+                hsh = await self.write_to_file(tmp_file, self.reader, data_len, data_iv)
                 buffer = tmp_file
 
-            hsh = int.from_bytes(hsh, 'big')
-
-            # receive and verify the signature
-            signature = await self.reader.read(2048)
-
-            signature = int.from_bytes(signature, 'big')
-
-            server_pub_key = self.server_public_key
-
-            hash_from_sign = pow(signature, server_pub_key.e, server_pub_key.n)
+            # receive and verify the MAC
+            mac = await self.reader.readexactly(MAC_SIZE)
 
-
-            if hsh != hash_from_sign:
+            if not hmac.compare_digest(mac, hsh):
                 # the file was modified from the last signed
                 print("something wrong with the signature")
                 pass
@@ -239,30 +247,23 @@ class Client:
 
         iv = SymmetricEncryptor.generate_iv()
 
-        self.writer.write(iv)
+        len_iv, header_iv, data_iv = SymmetricEncryptor.derive_ivs(iv, 3)
 
-        encrypted_data = self.encryptor.encrypt(data, iv)
+        encrypted_data = self.encryptor.encrypt(data, data_iv)
 
         header = json.dumps({'event': event, 'data_length': len(encrypted_data)}).encode()
 
-        encrypted_header = self.encryptor.encrypt(header, iv)
-
-        encrypted_len = self.encryptor.encrypt(len(encrypted_header).to_bytes(8, 'big'), iv)
-
-        self.writer.write(encrypted_len)
+        encrypted_header = self.encryptor.encrypt(header, header_iv)
 
-        self.writer.write(encrypted_header)
+        encrypted_len = self.encryptor.encrypt(len(encrypted_header).to_bytes(8, 'big'), len_iv)
 
-        self.writer.write(encrypted_data)
+        mac = self.encryptor.mac(data)
 
-        # generate and send the signature
-        hsh = int.from_bytes(sha512(data).digest(), 'big')
-        signature = pow(hsh, self.client_private_key.d, self.client_private_key.n)
+        # the whole frame goes to the transport in a single call, on Python 3.12+ without joining it into a copy
+        async with self._send_lock:
+            self.writer.writelines((iv, encrypted_len, encrypted_header, encrypted_data, mac))
 
-        # here we must send the signature
-        self.writer.write(signature.to_bytes(2048, 'big'))
-
-        await self.writer.drain()
+            await self.writer.drain()
 
     async def send_file(self, event: str, path: Path):
         if not self.is_connected():
@@ -270,42 +271,52 @@ class Client:
 
         iv = SymmetricEncryptor.generate_iv()
 
-        self.writer.write(iv)
+        len_iv, header_iv, data_iv = SymmetricEncryptor.derive_ivs(iv, 3)
 
         data_size = path.stat().st_size
 
-        padding_len = 16 - data_size % 16
+        header = json.dumps({'event': event, 'data_length': data_size + TAG_SIZE}).encode()
 
-        header = json.dumps({'event': event, 'data_length': data_size + padding_len}).encode()
+        encrypted_header = self.encryptor.encrypt(header, header_iv)
 
-        encrypted_header = self.encryptor.encrypt(header, iv)
+        encrypted_len = self.encryptor.encrypt(len(encrypted_header).to_bytes(8, 'big'), len_iv)
 
-        encrypted_len = self.encryptor.encrypt(len(encrypted_header).to_bytes(8, 'big'), iv)
+        async with self._send_lock:
+            self.writer.write(iv + encrypted_len + encrypted_header)
+            file_hash = self.encryptor.new_mac()
+            encryptor = self.encryptor.new_encryptor(data_iv)
+            loop = asyncio.get_running_loop()
+            with open(path, 'rb') as f:
+                if hasattr(os, 'posix_fadvise'):
+                    # the file is streamed front to back, let the kernel read ahead aggressively
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
 
-        self.writer.write(encrypted_len)
+                batch = []
+                while True:
+                    data = await loop.run_in_executor(None, f.read, CHUNK)
 
-        self.writer.write(encrypted_header)
-        file_hash = sha512()
-        with open(path, 'rb') as f:
-            while True:
-                data = f.read(1024)
+                    if not data:
+                        break
+
+                    file_hash.update(data)
 
-                if not data:
-                    break
+                    batch.append(encryptor.update(data))
 
-                file_hash.update(data)
+                    if len(batch) == WRITE_BATCH:
+                        self.writer.writelines(batch)
+                        batch = []
+                        await self.writer.drain()
 
-                self.writer.write(self.encryptor.encrypt(data, iv))
+            batch.append(encryptor.finalize())
 
-        # generate and send the signature
-        hsh = int.from_bytes(file_hash.digest(), 'big')
+            batch.append(encryptor.tag)
 
-        signature = pow(hsh, self.client_private_key.d, self.client_private_key.n)
+            # the MAC goes out with the last batch
+            batch.append(file_hash.digest())
 
-        # here we must send the signature
-        self.writer.write(signature.to_bytes(2048, 'big'))
+            self.writer.writelines(batch)
 
-        await self.writer.drain()
+            await self.writer.drain()
 
     async def terminate(self):
         self.writer.close()
@@ -315,12 +326,30 @@ class Client:
         self.reader = None
 
 
-def edit_file(file_name: str):
+async def read_line(stdin_queue: Optional[asyncio.Queue], prompt: str = '') -> str:
+    if stdin_queue is None:
+        # stdin can't be watched by the loop, block a pool thread in input() instead
+        return await asyncio.get_running_loop().run_in_executor(None, input, prompt)
+
+    print(prompt, end='', flush=True)
+
+    line = await stdin_queue.get()
+
+    if not line:
+        if not sys.stdin.isatty():
+            # a closed pipe stays at EOF for every later read too
+            stdin_queue.put_nowait(line)
+        raise EOFError
+
+    return line.rstrip('\n')
+
+
+async def edit_file(file_name: str, stdin_queue: Optional[asyncio.Queue]):
     with open(f'{file_name}', 'ab') as f:
         print("Enter Your New Text.")
         try:
             while True:
-                s = input()
+                s = await read_line(stdin_queue)
                 f.write(s.encode())
         except EOFError:
             pass
@@ -361,9 +390,10 @@ async def main(args):
         cs_file = f'CS/{client.name}_cs.cs'
 
         client.cs = crypto.load_certificate(crypto.FILETYPE_PEM, data)
+        client.cs_pem = crypto.dump_certificate(crypto.FILETYPE_PEM, client.cs)
 
         with open(cs_file, 'wb+') as file:
-            file.write(crypto.dump_certificate(crypto.FILETYPE_PEM, client.cs))
+            file.write(client.cs_pem)
 
         cs_event.set()
 
@@ -404,54 +434,100 @@ async def main(args):
             await client.terminate()
         cs_event.set()
 
-    with ThreadPoolExecutor(2) as pool:
-        try:
-            connection_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
 
-            asyncio.ensure_future(client.create_connection(connection_event))
+    # stdin lines are queued by the event loop instead of a thread blocking in input()
+    stdin_queue: Optional[asyncio.Queue] = asyncio.Queue()
 
-            await connection_event.wait()
+    stdin_fd = sys.stdin.fileno()
 
-            await cs_event.wait()
+    # the bytes after the last newline, queued once the rest of their line arrives
+    partial_line = bytearray()
 
-            print("sending cs to server")
-            await client.send("recv_client_cs", crypto.dump_certificate(crypto.FILETYPE_PEM, client.cs))
-            print("done sending cs to server")
-            # await cs_verification_event.wait()
+    def read_stdin():
+        # os.read returns what is available, nothing is left behind in a userspace buffer
+        data = os.read(stdin_fd, CHUNK)
 
-            if client.reader is None:
-                return
+        if data:
+            partial_line.extend(data)
 
-            while True:
-                result = await asyncio.get_running_loop().run_in_executor(pool, input, 'Enter Your Command: ')
+            *lines, rest = partial_line.split(b'\n')
 
-                result = int(result)
+            # consume the lines before queueing them, a line must never be split out twice
+            partial_line[:] = rest
 
-                if not result:
-                    break
+            for line in lines:
+                stdin_queue.put_nowait(line.decode(errors='replace') + '\n')
+            return
 
-                if result == 1:
-                    view_event.clear()
-                    file_name = await asyncio.get_running_loop().run_in_executor(pool, input, 'Enter file name: ')
-                    await client.send('view', file_name.encode())
-                    print("waiting for server response...")
-                    await view_event.wait()
-                    await asyncio.get_running_loop().run_in_executor(pool, input, 'Enter Any Key..')
+        line = partial_line.decode(errors='replace')
+        partial_line.clear()
 
-                if result == 2:
-                    file_name = await asyncio.get_running_loop().run_in_executor(pool, input, 'Enter file name: ')
+        if line:
+            stdin_queue.put_nowait(line)
 
-                    with open(f'{file_name}', 'wb') as f:
-                        f.write(len(file_name).to_bytes(8, 'big'))
-                        f.write(file_name.encode())
+        if not os.isatty(stdin_fd):
+            # a closed pipe stays readable, stop polling it
+            loop.remove_reader(stdin_fd)
 
-                    await asyncio.get_running_loop().run_in_executor(pool, edit_file, file_name)
+        stdin_queue.put_nowait('')
 
-                    await client.send_file('file_edit', Path(f'{file_name}'))
+    try:
+        loop.add_reader(stdin_fd, read_stdin)
+    except (PermissionError, NotImplementedError):
+        # regular files can't be polled, and the Windows proactor loop has no add_reader
+        stdin_queue = None
 
-                    os.remove(file_name)
+    try:
+        connection_event = asyncio.Event()
 
-        except ConnectionError:
-            pass
-        except Exception as e:
-            logging.error(e, exc_info=e)
+        asyncio.ensure_future(client.create_connection(connection_event))
+
+        await connection_event.wait()
+
+        await cs_event.wait()
+
+        print("sending cs to server")
+        await client.send("recv_client_cs", client.cs_pem)
+        print("done sending cs to server")
+        # await cs_verification_event.wait()
+
+        if client.reader is None:
+            return
+
+        while True:
+            result = await read_line(stdin_queue, 'Enter Your Command: ')
+
+            result = int(result)
+
+            if not result:
+                break
+
+            if result == 1:
+                view_event.clear()
+                file_name = await read_line(stdin_queue, 'Enter file name: ')
+                await client.send('view', file_name.encode())
+                print("waiting for server response...")
+                await view_event.wait()
+                await read_line(stdin_queue, 'Enter Any Key..')
+
+            if result == 2:
+                file_name = await read_line(stdin_queue, 'Enter file name: ')
+
+                with open(f'{file_name}', 'wb') as f:
+                    f.write(len(file_name).to_bytes(8, 'big'))
+                    f.write(file_name.encode())
+
+                await edit_file(file_name, stdin_queue)
+
+                await client.send_file('file_edit', Path(f'{file_name}'))
+
+                os.remove(file_name)
+
+    except ConnectionError:
+        pass
+    except Exception as e:
+        logging.error(e, exc_info=e)
+    finally:
+        if stdin_queue is not None:
+            loop.remove_reader(stdin_fd)
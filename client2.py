@@ -1,5 +1,5 @@
 from client import main
-import asyncio
+from runner import run
 import argparse
 
 parser = argparse.ArgumentParser()
@@ -16,4 +16,4 @@ parser.add_argument("remote_port",
 
 args = parser.parse_args()
 
-asyncio.run(main(args))
+run(main(args))
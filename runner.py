@@ -0,0 +1,16 @@
+import asyncio
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+def run(coroutine):
+    # uvloop is optional, without it the default asyncio loop is used
+    if uvloop is None:
+        return asyncio.run(coroutine)
+
+    # the runner cancels leftover tasks and shuts down async generators and the executor like asyncio.run
+    with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+        return runner.run(coroutine)
@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import functools
+import hmac
 import json
 import os
 import tempfile
@@ -9,18 +10,26 @@ from pathlib import Path
 from typing import Dict, Tuple, Callable, Coroutine, Optional
 from typing.io import IO
 from enum import Enum, auto
-from Crypto.PublicKey import RSA
-from hashlib import sha512
 from OpenSSL import crypto
-from Encryptor import SymmetricEncryptor, AsymmetricEncryptor
+from cryptography.exceptions import InvalidTag
+from Encryptor import SymmetricEncryptor, AsymmetricEncryptor, BLOCK_SIZE, NONCE_SIZE, TAG_SIZE, MAC_SIZE
 from client import Client
 
 TYPE_RSA = crypto.TYPE_RSA
 
-CHUNK = 1024
+CHUNK = 64 * 1024
+
+# chunks coalesced by send_file into one write, the writer is drained after each
+WRITE_BATCH = 4
 
 BUFFER_LIMIT = 256 * 1024 * 1024
 
+# below this size decrypting and hashing inline is cheaper than the hop to the pool
+OFFLOAD_DECRYPT_SIZE = 1024 * 1024
+
+# payloads are only offloaded once this many clients may be sending at the same time
+OFFLOAD_MIN_CLIENTS = 4
+
 
 class DataMode(Enum):
     FILE = auto()
@@ -43,12 +52,19 @@ class Server:
 
         self.public_key, self.private_key = AsymmetricEncryptor.read_key_pairs(keys)
 
+        self._openssl_key = crypto.load_privatekey(crypto.FILETYPE_PEM, self.private_key.export_key())
+
+        self._public_pem = self.public_key.export_key()
+
         self.encryptors: Dict[Tuple[str, int], SymmetricEncryptor] = {}
 
-        self.clients_public_keys = {}
+        # frames of concurrent send and send_file calls must not interleave on a client's writer
+        self.send_locks: Dict[Tuple[str, int], asyncio.Lock] = {}
+
         self.certData = {}
         self.csr = crypto.X509Req()
         self.cs = crypto.X509Req()
+        self.cs_pem: Optional[bytes] = None
         self.generate_csr()
 
         @self.event()
@@ -98,35 +114,57 @@ class Server:
         req.get_subject().organizationName = 'AI inc.'
         req.get_subject().organizationalUnitName = 'Information Security'
 
-        opensslPublicKey = crypto.load_publickey(crypto.FILETYPE_PEM,
-                                                 open(f'server_keys/{self.name}_public.pem').read())
-        opensslPrivateKey = crypto.load_privatekey(crypto.FILETYPE_PEM,
-                                                   open(f'server_keys/{self.name}_private.pem').read())
-
-        req.set_pubkey(opensslPublicKey)
-        req.sign(opensslPrivateKey, "sha1")
+        # Set the public key of the certificate to the already loaded key pair.
+        req.set_pubkey(self._openssl_key)
+        req.sign(self._openssl_key, "sha256")
 
         self.csr = req
 
+    def decrypt_and_hash(self, sid: Tuple[str, int], encrypted_data: bytes, iv: bytes):
+        data = self.encryptors[sid].decrypt(encrypted_data, iv)
+
+        return data, self.encryptors[sid].mac(data)
+
     async def write_to_file(self, sid: Tuple[str, int], file: IO,
                             reader: asyncio.StreamReader, data_len: int, iv: bytes):
-        remaining = data_len
-        file_hash = sha512()
-        while remaining > 0:
-            chunk = min(remaining, CHUNK)
+        loop = asyncio.get_running_loop()
+        remaining = data_len - TAG_SIZE
+        file_hash = self.encryptors[sid].new_mac()
+        decryptor = self.encryptors[sid].new_decryptor(iv)
 
-            encrypted_data = await reader.read(chunk)
+        # update_into needs room for one extra block
+        plain_buffer = bytearray(CHUNK + BLOCK_SIZE - 1)
+        plain_view = memoryview(plain_buffer)
 
-            if len(encrypted_data) != chunk:
-                raise ConnectionError
+        def decrypt_chunk(encrypted_data: bytes):
+            data = plain_view[:decryptor.update_into(encrypted_data, plain_buffer)]
 
-            data = self.encryptors[sid].decrypt(encrypted_data, iv)
+            file_hash.update(data)
 
             file.write(data)
 
-            file_hash.update(data)
+        # the previous chunk is decrypted in the pool while the next one is received
+        pending = None
+        try:
+            while remaining > 0:
+                chunk = min(remaining, CHUNK)
 
-            remaining -= chunk
+                encrypted_data = await reader.readexactly(chunk)
+
+                if pending is not None:
+                    await pending
+
+                pending = loop.run_in_executor(None, decrypt_chunk, encrypted_data)
+
+                remaining -= chunk
+
+            tag = await reader.readexactly(TAG_SIZE)
+        finally:
+            # never leave a chunk being written to the file when the peer goes away
+            if pending is not None:
+                await pending
+
+        decryptor.finalize_with_tag(tag)
 
         return file_hash.digest()
 
@@ -135,62 +173,62 @@ class Server:
 
         sid = writer.get_extra_info('peername')
 
-        self.clients[sid] = sio
-
         # RECEIVING CLIENT PUBLIC KEY
-        client_pub_key_len = int.from_bytes(await reader.read(8), 'big')
+        client_pub_key_len = int.from_bytes(await reader.readexactly(8), 'big')
 
-        self.clients_public_keys[sid] = RSA.import_key(await reader.read(client_pub_key_len))
+        # the key itself is unused, it is only consumed to keep the handshake framing
+        await reader.readexactly(client_pub_key_len)
 
         # SENDING SERVER PUBLIC KEY TO CLIENT
-        writer.write(len(self.public_key.export_key()).to_bytes(8, 'big'))
+        writer.write(len(self._public_pem).to_bytes(8, 'big'))
 
-        writer.write(self.public_key.export_key())
+        writer.write(self._public_pem)
 
         await writer.drain()
 
         # RECEIVING ENCRYPTED SESSION KEY FROM CLIENT
-        data_len = int.from_bytes(await reader.read(8), 'big')
+        data_len = int.from_bytes(await reader.readexactly(8), 'big')
 
-        enc_session_key = await reader.read(data_len)
+        enc_session_key = await reader.readexactly(data_len)
 
         session_key = AsymmetricEncryptor.decrypt(self.private_key, enc_session_key)
 
-        self.encryptors[sid] = SymmetricEncryptor(session_key)
-
-        await self.events['connect'][0](sid, None)
+        # the client is registered only once the handshake is done, the finally below unregisters it
+        self.clients[sid] = sio
 
-        if self.name != 'CA':
-            cs_file = f'CS/{self.name}_cs.cs'
+        self.encryptors[sid] = SymmetricEncryptor(session_key)
 
-            await self.send(sid, 'recv_server_cs', open(cs_file, 'rb').read())
+        self.send_locks[sid] = asyncio.Lock()
 
         async def default_event(param):
             pass
 
         try:
-            while True:
+            await self.events['connect'][0](sid, None)
 
-                iv = await reader.read(16)
+            if self.name != 'CA':
+                if self.cs_pem is None:
+                    with open(f'CS/{self.name}_cs.cs', 'rb') as f:
+                        self.cs_pem = f.read()
 
-                if len(iv) != 16:
-                    raise ConnectionError
+                await self.send(sid, 'recv_server_cs', self.cs_pem)
 
-                encrypted_data = await reader.read(16)
+            while True:
 
-                if len(encrypted_data) != 16:
-                    raise ConnectionError
+                # the nonce and the sealed header length arrive together
+                frame = await reader.readexactly(NONCE_SIZE + 8 + TAG_SIZE)
 
-                data = self.encryptors[sid].decrypt(encrypted_data, iv)
+                iv, encrypted_data = frame[:NONCE_SIZE], frame[NONCE_SIZE:]
 
-                data_len = int.from_bytes(data, 'big')
+                len_iv, header_iv, data_iv = SymmetricEncryptor.derive_ivs(iv, 3)
 
-                encrypted_data = await reader.read(data_len)
+                data = self.encryptors[sid].decrypt(encrypted_data, len_iv)
 
-                if len(encrypted_data) != data_len:
-                    raise ConnectionError
+                data_len = int.from_bytes(data, 'big')
+
+                encrypted_data = await reader.readexactly(data_len)
 
-                data = self.encryptors[sid].decrypt(encrypted_data, iv)
+                data = self.encryptors[sid].decrypt(encrypted_data, header_iv)
 
                 data = json.loads(data)
 
@@ -201,35 +239,28 @@ class Server:
                                                               DataMode.FILE if data_len > BUFFER_LIMIT
                                                               else DataMode.BYTES))
                 buffer = None
-                hsh = 0
+                hsh = None
                 if data_mode == DataMode.BYTES:
-                    buffer = await reader.read(data_len)
-
-                    if len(buffer) != data_len:
-                        raise ConnectionError
+                    buffer = await reader.readexactly(data_len)
 
-                    buffer = self.encryptors[sid].decrypt(buffer, iv)
-
-                    hsh = sha512(buffer).digest()
+                    if (data_len >= OFFLOAD_DECRYPT_SIZE and len(self.clients) >= OFFLOAD_MIN_CLIENTS
+                            and (os.cpu_count() or 1) > 1):
+                        # large payloads of concurrent clients are decrypted and hashed in parallel by the pool
+                        buffer, hsh = await asyncio.get_running_loop().run_in_executor(
+                            None, self.decrypt_and_hash, sid, buffer, data_iv)
+                    else:
+                        buffer, hsh = self.decrypt_and_hash(sid, buffer, data_iv)
 
                 if data_mode == DataMode.FILE:
                     tmp_file = tempfile.TemporaryFile()
-                    hsh = await self.write_to_file(sid, tmp_file, reader, data_len, iv)
+                    hsh = await self.write_to_file(sid, tmp_file, reader, data_len, data_iv)
                     tmp_file.seek(0)
                     buffer = tmp_file
 
-                hsh = int.from_bytes(hsh, 'big')
-
-                # receive and verify the signature
-                signature = await reader.read(2048)
-
-                signature = int.from_bytes(signature, 'big')
+                # receive and verify the MAC
+                mac = await reader.readexactly(MAC_SIZE)
 
-                client_pub_key = self.clients_public_keys[sid]
-
-                hash_from_sign = pow(signature, client_pub_key.e, client_pub_key.n)
-
-                if hsh != hash_from_sign:
+                if not hmac.compare_digest(mac, hsh):
                     # the file was modified from the last signed
                     print("something wrong with the signature")
                     pass
@@ -239,7 +270,7 @@ class Server:
 
                 asyncio.ensure_future(event_coroutine(sid, buffer))
 
-        except ConnectionError:
+        except (ConnectionError, asyncio.IncompleteReadError, InvalidTag):
             asyncio.ensure_future(self.events['disconnect'][0](sid, None))
         finally:
             writer.close()
@@ -248,38 +279,31 @@ class Server:
             except ConnectionError:
                 pass
             del self.clients[sid]
-            del self.clients_public_keys[sid]
             del self.encryptors[sid]
+            del self.send_locks[sid]
 
     async def send(self, to: Tuple[str, int], event: str, data: bytes):
         _, writer = self.clients[to]
 
         iv = SymmetricEncryptor.generate_iv()
 
-        writer.write(iv)
+        len_iv, header_iv, data_iv = SymmetricEncryptor.derive_ivs(iv, 3)
 
-        encrypted_data = self.encryptors[to].encrypt(data, iv)
+        encrypted_data = self.encryptors[to].encrypt(data, data_iv)
 
         header = json.dumps({'event': event, 'data_length': len(encrypted_data)}).encode()
 
-        encrypted_header = self.encryptors[to].encrypt(header, iv)
-
-        encrypted_len = self.encryptors[to].encrypt(len(encrypted_header).to_bytes(8, 'big'), iv)
+        encrypted_header = self.encryptors[to].encrypt(header, header_iv)
 
-        writer.write(encrypted_len)
+        encrypted_len = self.encryptors[to].encrypt(len(encrypted_header).to_bytes(8, 'big'), len_iv)
 
-        writer.write(encrypted_header)
+        mac = self.encryptors[to].mac(data)
 
-        writer.write(encrypted_data)
+        # the whole frame goes to the transport in a single call, on Python 3.12+ without joining it into a copy
+        async with self.send_locks[to]:
+            writer.writelines((iv, encrypted_len, encrypted_header, encrypted_data, mac))
 
-        hsh = int.from_bytes(sha512(data).digest(), 'big')
-
-        signature = pow(hsh, self.private_key.d, self.private_key.n)
-
-        # here we must send the signature
-        writer.write(signature.to_bytes(2048, 'big'))
-
-        await writer.drain()
+            await writer.drain()
 
     async def send_file(self, to: Tuple[str, int], event: str, path: Path):
 
@@ -288,46 +312,58 @@ class Server:
 
         iv = SymmetricEncryptor.generate_iv()
 
-        writer.write(iv)
+        len_iv, header_iv, data_iv = SymmetricEncryptor.derive_ivs(iv, 3)
 
         data_size = path.stat().st_size
 
-        padding_len = 16 - data_size % 16
+        header = json.dumps({'event': event, 'data_length': data_size + TAG_SIZE}).encode()
 
-        header = json.dumps({'event': event, 'data_length': data_size + padding_len}).encode()
+        encrypted_header = self.encryptors[to].encrypt(header, header_iv)
 
-        encrypted_header = self.encryptors[to].encrypt(header, iv)
+        encrypted_len = self.encryptors[to].encrypt(len(encrypted_header).to_bytes(8, 'big'), len_iv)
 
-        encrypted_len = self.encryptors[to].encrypt(len(encrypted_header).to_bytes(8, 'big'), iv)
+        async with self.send_locks[to]:
+            writer.write(iv + encrypted_len + encrypted_header)
 
-        writer.write(encrypted_len)
+            file_hash = self.encryptors[to].new_mac()
 
-        writer.write(encrypted_header)
+            encryptor = self.encryptors[to].new_encryptor(data_iv)
 
-        file_hash = sha512()
+            loop = asyncio.get_running_loop()
 
-        with open(path, 'rb') as f:
-            while True:
-                data = f.read(CHUNK)
+            with open(path, 'rb') as f:
+                if hasattr(os, 'posix_fadvise'):
+                    # the file is streamed front to back, let the kernel read ahead aggressively
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+                batch = []
+                while True:
+                    data = await loop.run_in_executor(None, f.read, CHUNK)
+
+                    if not data:
+                        break
 
-                if not data:
-                    break
+                    encrypted_data = encryptor.update(data)
 
-                encrypted_data = self.encryptors[to].encrypt(data, iv)
+                    batch.append(encrypted_data)
 
-                writer.write(encrypted_data)
+                    file_hash.update(data)
 
-                file_hash.update(data)
+                    if len(batch) == WRITE_BATCH:
+                        writer.writelines(batch)
+                        batch = []
+                        await writer.drain()
 
-        # generate and send the signature
-        hsh = int.from_bytes(file_hash.digest(), 'big')
+            batch.append(encryptor.finalize())
 
-        signature = pow(hsh, self.private_key.d, self.private_key.n)
+            batch.append(encryptor.tag)
 
-        # here we must send the signature
-        writer.write(signature.to_bytes(2048, 'big'))
+            # the MAC goes out with the last batch
+            batch.append(file_hash.digest())
 
-        await writer.drain()
+            writer.writelines(batch)
+
+            await writer.drain()
 
     async def terminate_connection(self, sid):
         reader, writer = self.clients[sid]
@@ -392,9 +428,10 @@ async def start_server(name='Nitro', host='localhost', port=8080):
         cs_file = f'CS/{server.name}_cs.cs'
 
         server.cs = crypto.load_certificate(crypto.FILETYPE_PEM, data)
+        server.cs_pem = crypto.dump_certificate(crypto.FILETYPE_PEM, server.cs)
 
         with open(cs_file, 'wb+') as f:
-            f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, server.cs))
+            f.write(server.cs_pem)
         cs_event.set()
 
     cs_event.clear()
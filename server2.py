@@ -1,5 +1,5 @@
 from server import start_server
-import asyncio
+from runner import run
 import argparse
 
 parser = argparse.ArgumentParser()
@@ -15,4 +15,4 @@ parser.add_argument("port",
 
 args = parser.parse_args()
 
-asyncio.run(start_server(args.name, args.host, args.port))
+run(start_server(args.name, args.host, args.port))